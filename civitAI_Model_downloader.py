@@ -5,10 +5,21 @@ import logging
 import urllib.parse
 import os
 import threading
-from concurrent.futures import ThreadPoolExecutor
+import queue
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from tqdm import tqdm
 import time
 import argparse
+import functools
+import collections
+import hashlib
+from urllib3.util.retry import Retry
+
+# orjson is optional; it parses the large API pages several times faster than the standard json module.
+try:
+    import orjson
+except ImportError:
+    orjson = None
 
 # Constants
 SCRIPT_DIR = os.path.dirname(os.path.abspath(__file__))
@@ -19,6 +30,28 @@ OUTPUT_DIR = "model_downloads"
 MAX_PATH_LENGTH = 200
 VALID_DOWNLOAD_TYPES = ['Lora', 'Checkpoints', 'Embeddings', 'Training_Data', 'Other', 'All']
 BASE_URL = "https://civitai.com/api/v1/models"
+CHUNK_SIZE = 1 << 20  # Read and write downloads in 1 MiB chunks.
+PROGRESS_UPDATE_INTERVAL = 0.25  # Seconds between progress bar refreshes.
+LARGE_FILE_SIZE = 50 << 20  # Files above this size also get their own progress bar.
+WRITER_THREADS = 2  # Threads that write downloaded chunks to disk.
+WRITE_QUEUE_SIZE = 32  # Chunks buffered per writer thread before downloads wait for the disk.
+WRITER_CHECK_INTERVAL = 1.0  # Seconds between checks that a busy writer thread is still alive.
+INVALID_NAME_CHARS_RE = re.compile(r'[<>:"/\\|?*\x00-\x1f\x7f-\x9f]')
+REPEATED_UNDERSCORES_RE = re.compile(r'__+')
+HTML_TAG_RE = re.compile(r'<[^>]*>')
+CONTENT_RANGE_RE = re.compile(r'bytes (\d+)-\d+/(\d+|\*)')
+# Model types as spelled by the API, plus upper-case forms for any other casing.
+CATEGORY_BY_TYPE = {
+    'Checkpoint': 'Checkpoints',
+    'CHECKPOINT': 'Checkpoints',
+    'TextualInversion': 'Embeddings',
+    'TEXTUALINVERSION': 'Embeddings',
+    'LORA': 'Lora',
+    'Training_Data': 'Training_Data',
+    'TRAINING_DATA': 'Training_Data',
+}
+RESERVED_NAMES = frozenset(["CON", "PRN", "AUX", "NUL", *(f"COM{i}" for i in range(1, 10)), *(f"LPT{i}" for i in range(1, 10))])
+SUMMARY_COUNT_WIDTH = 10  # Fixed width of the counts in the summary file header.
 
 # Set up logging using our custom logger.
 logger_md = logging.getLogger('md')
@@ -29,12 +62,29 @@ formatter = logging.Formatter('%(asctime)s - %(levelname)s - %(message)s')
 file_handler_md.setFormatter(formatter)
 logger_md.addHandler(file_handler_md)
 
+download_errors_logger_lock = threading.Lock()
+
+def get_download_errors_logger(username):
+    """Return the logger writing to logs/<username>.download_errors.log.
+    The file handler is thread-safe and only opens the file once the first error is logged.
+    """
+    logger = logging.getLogger(f'md.download_errors.{username}')
+    with download_errors_logger_lock:
+        # Several download threads may hit their first error at once; only one may add the handler.
+        if not logger.handlers:
+            handler = logging.FileHandler(os.path.join(LOGS_DIR, f'{username}.download_errors.log'), encoding='utf-8', delay=True)
+            handler.setFormatter(logging.Formatter('%(message)s'))
+            logger.addHandler(handler)
+            logger.propagate = False
+    return logger
+
 # Argument parsing
 parser = argparse.ArgumentParser(description="Download model files and images from Civitai API.")
 parser.add_argument("usernames", nargs='+', type=str, help="Enter one or more usernames you want to download from.")
 parser.add_argument("--retry_delay", type=int, default=10, help="Retry delay in seconds.")
 parser.add_argument("--max_tries", type=int, default=3, help="Maximum number of retries.")
 parser.add_argument("--max_threads", type=int, default=5, help="Maximum number of concurrent threads. Too many produces API Failure.")
+parser.add_argument("--max_users", type=int, default=1, help="Number of usernames processed at the same time. They share --max_threads.")
 parser.add_argument("--token", type=str, default=None, help="API Token for Civitai.")
 
 # Mutually exclusive group for filtering options
@@ -73,47 +123,82 @@ usernames = args.usernames
 retry_delay = args.retry_delay
 max_tries = args.max_tries
 max_threads = args.max_threads
+# Usernames are independent, so --max_users of them may run at once, splitting max_threads between them.
+user_workers = max(1, min(len(usernames), args.max_users))
+user_threads = max(1, max_threads // user_workers)
+# Set on Ctrl+C so usernames still running in worker threads stop taking new work.
+stop_requested = threading.Event()
 token = args.token
+# Query string appended to every file download URL.
+download_query = urllib.parse.urlencode({'token': token, 'nsfw': 'true'})
 
 def sanitize_directory_name(name):
     return name.rstrip()
 
+# Directories already created during this run, so repeated files in one folder skip the makedirs syscalls.
+created_dirs = set()
+created_dirs_lock = threading.Lock()
+
+def ensure_dir(path):
+    """Create a directory (and its parents) once per run."""
+    if path in created_dirs:
+        return
+    os.makedirs(path, exist_ok=True)
+    with created_dirs_lock:
+        created_dirs.add(path)
+
 # Create output directory.
 OUTPUT_DIR = sanitize_directory_name(OUTPUT_DIR)
-os.makedirs(OUTPUT_DIR, exist_ok=True)
+ensure_dir(OUTPUT_DIR)
 
-# Create a persistent session.
+# Create a persistent session whose connection pool is shared by all worker threads.
+# Transport errors and 429/5xx responses are retried here with exponential backoff
+# based on --retry_delay, on the same pooled connections.
 session = requests.Session()
+retries = Retry(
+    total=max_tries,
+    backoff_factor=retry_delay,
+    status_forcelist=(429, 500, 502, 503, 504),
+    allowed_methods=frozenset(['GET', 'HEAD'])
+)
+# Room for one connection per image worker, model file worker and the page prefetch thread of every user worker.
+pool_maxsize = (user_threads * 4 + max(2, user_threads // 2) + 1) * user_workers
+adapter = requests.adapters.HTTPAdapter(pool_connections=max_threads, pool_maxsize=pool_maxsize, max_retries=retries)
+session.mount("https://", adapter)
+session.mount("http://", adapter)
+session.headers.update({
+    "Content-Type": "application/json",
+    "Authorization": f"Bearer {token}"
+})
 
-def read_summary_data(username):
-    """Read summary data from a file in the logs subfolder."""
-    summary_path = os.path.join(LOGS_DIR, f"{username}.txt")
-    data = {}
-    try:
-        with open(summary_path, 'r', encoding='utf-8') as file:
-            for line in file:
-                if 'Total - Count:' in line:
-                    total_count = int(line.strip().split(':')[1].strip())
-                    data['Total'] = total_count
-                elif ' - Count:' in line:
-                    category, count = line.strip().split(' - Count:')
-                    data[category.strip()] = int(count.strip())
-    except FileNotFoundError:
-        print(f"File {summary_path} not found.")
-    return data
+def request_page(url):
+    """Request one page of the models API."""
+    return session.get(url, timeout=(20, 40))
 
+def decode_json_response(response):
+    """Decode a JSON API response, using orjson when it is installed."""
+    if orjson is not None:
+        return orjson.loads(response.content)
+    return response.json()
+
+@functools.lru_cache(maxsize=8192)
 def sanitize_name(name, folder_name=None, max_length=MAX_PATH_LENGTH, subfolder=None, output_dir=None, username=None):
-    """Sanitize a name for use as a file or folder name."""
-    base_name, extension = os.path.splitext(name)
+    """Sanitize a name for use as a file or folder name.
+    name may also be a (base name, extension) tuple the caller has already split.
+    """
+    if isinstance(name, tuple):
+        base_name, extension = name
+        name = base_name + extension
+    else:
+        base_name, extension = os.path.splitext(name)
     if folder_name and base_name == folder_name:
         return name
     if folder_name:
         base_name = base_name.replace(folder_name, "").strip("_")
-    base_name = re.sub(r'[<>:"/\\|?*\x00-\x1f\x7f-\x9f]', '_', base_name)
-    reserved_names = {"CON", "PRN", "AUX", "NUL"} | {f"COM{i}" for i in range(1, 10)} | {f"LPT{i}" for i in range(1, 10)}
-    if base_name.upper() in reserved_names:
+    base_name = INVALID_NAME_CHARS_RE.sub('_', base_name)
+    if base_name.upper() in RESERVED_NAMES:
         base_name = '_'
-    base_name = re.sub(r'__+', '_', base_name).strip('_.')
+    base_name = REPEATED_UNDERSCORES_RE.sub('_', base_name).strip('_.')
     if subfolder and output_dir and username:
         path_length = len(os.path.join(output_dir, username, subfolder))
         max_base_length = max_length - len(extension) - path_length
@@ -121,87 +206,243 @@ def sanitize_name(name, folder_name=None, max_length=MAX_PATH_LENGTH, subfolder=
     sanitized_name = base_name + extension
     return sanitized_name.strip()
 
-def download_file_or_image(url, output_path, username, retry_count=0, max_retries=max_tries):
-    """Download a file or image from the URL, adjusting the file extension if needed."""
-    if os.path.exists(output_path):
-        return False
-    os.makedirs(os.path.dirname(output_path), exist_ok=True)
-    progress_bar = None
+def disk_writer(write_queue):
+    """Apply queued ("open", path, (mode, errors)), ("write", path, chunk) and ("close", path, done)
+    messages to disk. Errors are appended to the errors list of the file's open message as soon
+    as they happen, and later writes for that file are dropped.
+    """
+    open_files = {}
+    file_errors = {}
+    while True:
+        action, path, payload = write_queue.get()
+        try:
+            if action == "open":
+                mode, file_errors[path] = payload
+                open_files[path] = open(path, mode)
+            elif action == "write":
+                if path in open_files:
+                    open_files[path].write(payload)
+            elif action == "close":
+                file = open_files.pop(path, None)
+                if file:
+                    file.close()
+        except Exception as e:
+            file_errors.setdefault(path, []).append(e)
+            file = open_files.pop(path, None)
+            if file:
+                try:
+                    file.close()
+                except OSError:
+                    pass
+        if action == "close":
+            file_errors.pop(path, None)
+            payload.set()
+
+# Downloads hand their chunks to these writer threads, so a slow disk does not stall reading
+# from the socket. Every message for one path goes to the same writer, which keeps chunks in order.
+write_queues = [queue.Queue(maxsize=WRITE_QUEUE_SIZE) for _ in range(WRITER_THREADS)]
+writer_threads = [threading.Thread(target=disk_writer, args=(write_queue,), daemon=True) for write_queue in write_queues]
+for writer_thread in writer_threads:
+    writer_thread.start()
+
+def put_write_message(writer_index, message):
+    """Queue a message for a disk writer, raising RuntimeError if that writer thread has died."""
+    while True:
+        try:
+            write_queues[writer_index].put(message, timeout=WRITER_CHECK_INTERVAL)
+            return
+        except queue.Full:
+            if not writer_threads[writer_index].is_alive():
+                raise RuntimeError(f"Disk writer thread {writer_index} has stopped")
+
+def write_chunks(path, mode, chunks):
+    """Write chunks to path through the disk writer threads and wait until the file is closed.
+    Stops consuming chunks as soon as the writer reports an error, such as a full disk.
+    """
+    writer_index = hash(path) % len(write_queues)
+    done = threading.Event()
+    errors = []
+    put_write_message(writer_index, ("open", path, (mode, errors)))
     try:
-        response = session.get(url, stream=True, timeout=(20, 40))
-        if response.status_code == 404:
-            print(f"File not found: {url}")
-            return False
-        response.raise_for_status()
-        content_type = response.headers.get('Content-Type', '')
-        if 'image' in content_type:
-            file_extension = '.jpg'
-        elif 'video' in content_type:
-            file_extension = '.mp4'
-        else:
-            file_extension = os.path.splitext(output_path)[1]
-        output_path = os.path.splitext(output_path)[0] + file_extension
-        total_size = int(response.headers.get('content-length', 0))
-        progress_bar = tqdm(total=total_size, unit='B', unit_scale=True, leave=False)
-        with open(output_path, "wb") as file:
-            for chunk in response.iter_content(chunk_size=8192):
-                if chunk:
-                    progress_bar.update(len(chunk))
-                    file.write(chunk)
-        progress_bar.close()
-        if output_path.endswith('.safetensor') and os.path.getsize(output_path) < 4 * 1024 * 1024:
-            if retry_count < max_retries:
-                print(f"File {output_path} is smaller than expected. Retrying (attempt {retry_count}).")
-                time.sleep(retry_delay)
-                return download_file_or_image(url, output_path, username, retry_count + 1, max_retries)
-            else:
-                download_errors_log = os.path.join(LOGS_DIR, f'{username}.download_errors.log')
-                with open(download_errors_log, 'a', encoding='utf-8') as log_file:
-                    log_file.write(f"Failed to download {url} after {max_retries} attempts.\n")
-                return False
+        for chunk in chunks:
+            if errors:
+                break
+            put_write_message(writer_index, ("write", path, chunk))
+    finally:
+        put_write_message(writer_index, ("close", path, done))
+        while not done.wait(WRITER_CHECK_INTERVAL):
+            if not writer_threads[writer_index].is_alive():
+                raise RuntimeError(f"Disk writer thread {writer_index} has stopped")
+    if errors:
+        raise errors[0]
+
+def iter_raw_chunks(response):
+    """Read the response body in CHUNK_SIZE blocks straight from urllib3, without iter_content's generator layers.
+    The body is only decoded when the server sent a Content-Encoding.
+    """
+    decode_content = bool(response.headers.get('Content-Encoding'))
+    while True:
+        chunk = response.raw.read(CHUNK_SIZE, decode_content=decode_content)
+        if not chunk:
+            break
+        yield chunk
+
+def track_progress(chunks, progress_bars):
+    """Yield the non-empty chunks, updating progress_bars at most every PROGRESS_UPDATE_INTERVAL seconds."""
+    pending_bytes = 0
+    last_update = time.monotonic()
+    for chunk in chunks:
+        if not chunk:
+            continue
+        pending_bytes += len(chunk)
+        now = time.monotonic()
+        if now - last_update >= PROGRESS_UPDATE_INTERVAL:
+            for progress_bar in progress_bars:
+                progress_bar.update(pending_bytes)
+            pending_bytes = 0
+            last_update = now
+        yield chunk
+    for progress_bar in progress_bars:
+        progress_bar.update(pending_bytes)
+
+def download_name_variants(path):
+    """Return the names a finished download for path may have.
+    Images and videos are saved with the extension implied by their Content-Type,
+    so the .jpg and .mp4 variants are included.
+    """
+    base_path = os.path.splitext(path)[0]
+    return (path, base_path + '.jpg', base_path + '.mp4')
+
+def find_existing_download(output_path):
+    """Return the path of a finished download for output_path, or None."""
+    for candidate in download_name_variants(output_path):
+        if os.path.exists(candidate):
+            return candidate
+    return None
+
+def list_dir_names(path):
+    """Return the set of entry names in a directory with a single scandir call."""
+    with os.scandir(path) as entries:
+        return {entry.name for entry in entries}
+
+def is_downloaded(file_name, existing_names):
+    """Check a file name against a directory listing from list_dir_names."""
+    return any(name in existing_names for name in download_name_variants(file_name))
+
+def parse_content_range(response):
+    """Return (first byte, full size or None) from a 206 response's Content-Range header, or None."""
+    range_match = CONTENT_RANGE_RE.match(response.headers.get('Content-Range', ''))
+    if not range_match:
+        return None
+    first_byte, full_size = range_match.groups()
+    return int(first_byte), None if full_size == '*' else int(full_size)
+
+def download_file_or_image(url, output_path, username, total_progress, max_retries=max_tries):
+    """Download a file or image from the URL, adjusting the file extension if needed.
+    Bytes are counted on total_progress; the caller creates the target directory.
+    """
+    if find_existing_download(output_path):
         return True
-    except (requests.RequestException, Exception) as e:
-        if retry_count < max_retries:
-            print(f"Error downloading {url}: {e}. Retrying in {retry_delay} seconds (attempt {retry_count}).")
+    base_path, extension = os.path.splitext(output_path)
+    part_path = output_path + '.part'
+    error = None
+    for attempt in range(max_retries + 1):
+        if attempt:
             time.sleep(retry_delay)
-            return download_file_or_image(url, output_path, username, retry_count + 1, max_retries)
-        else:
-            download_errors_log = os.path.join(LOGS_DIR, f'{username}.download_errors.log')
-            with open(download_errors_log, 'a', encoding='utf-8') as log_file:
-                log_file.write(f"Failed to download {url} after {max_retries} attempts. Error: {e}\n")
-            return False
-    except (TimeoutError, ConnectionResetError) as e:
-        if progress_bar:
-            progress_bar.close()
-        if retry_count < max_retries:
-            print(f"Error during download: {url}, attempt {retry_count + 1}")
-            time.sleep(retry_delay)
-            return download_file_or_image(url, output_path, username, retry_count + 1, max_retries)
-        else:
-            download_errors_log = os.path.join(LOGS_DIR, f'{username}.download_errors.log')
-            with open(download_errors_log, 'a', encoding='utf-8') as log_file:
-                log_file.write(f"Error downloading file {output_path} from URL {url}: {e} after {max_retries} attempts\n")
-            return False
-    return True
+        progress_bar = None
+        try:
+            resume_from = os.path.getsize(part_path) if os.path.exists(part_path) else 0
+            range_headers = {"Range": f"bytes={resume_from}-"} if resume_from else None
+            response = session.get(url, stream=True, timeout=(20, 40), headers=range_headers)
+            content_range = parse_content_range(response) if response.status_code == 206 else None
+            if response.status_code == 416 or (response.status_code == 206 and
+                                               (content_range is None or content_range[0] != resume_from)):
+                # The partial file does not match the remote file any more; start over.
+                response.close()
+                os.remove(part_path)
+                resume_from = 0
+                response = session.get(url, stream=True, timeout=(20, 40))
+            if response.status_code == 404:
+                print(f"File not found: {url}")
+                return False
+            response.raise_for_status()
+            content_type = response.headers.get('Content-Type', '')
+            if 'image' in content_type:
+                file_extension = '.jpg'
+            elif 'video' in content_type:
+                file_extension = '.mp4'
+            else:
+                file_extension = extension
+            final_path = base_path + file_extension
+            if response.status_code != 206:
+                # The server ignored the Range header (no Accept-Ranges), so the body is the full file.
+                resume_from = 0
+            content_length = response.headers.get('content-length')
+            total_size = int(content_length or 0) + resume_from
+            # Expected size of the finished file; unknown for compressed or unsized bodies.
+            if content_range and content_range[1] is not None:
+                expected_size = content_range[1]
+            elif content_length and not response.headers.get('Content-Encoding'):
+                expected_size = total_size
+            else:
+                expected_size = None
+            progress_bars = [total_progress]
+            if total_size > LARGE_FILE_SIZE:
+                progress_bar = tqdm(total=total_size, initial=resume_from, unit='B', unit_scale=True, leave=False)
+                progress_bars.append(progress_bar)
+            chunks = iter_raw_chunks(response)
+            try:
+                write_chunks(part_path, "ab" if resume_from else "wb", track_progress(chunks, progress_bars))
+            finally:
+                # Release the connection even when writing failed before the whole body was read.
+                response.close()
+            if progress_bar:
+                progress_bar.close()
+            if final_path.endswith('.safetensor') and os.path.getsize(part_path) < 4 * 1024 * 1024:
+                os.remove(part_path)
+                error = "file is smaller than expected"
+                if attempt < max_retries:
+                    print(f"File {final_path} is smaller than expected. Retrying (attempt {attempt}).")
+                continue
+            part_size = os.path.getsize(part_path)
+            if expected_size is not None and part_size != expected_size:
+                if part_size > expected_size:
+                    os.remove(part_path)
+                error = f"got {part_size} of {expected_size} bytes"
+                if attempt < max_retries:
+                    print(f"File {final_path} has {part_size} of {expected_size} bytes. Retrying (attempt {attempt}).")
+                continue
+            os.replace(part_path, final_path)
+            return True
+        except (requests.exceptions.RetryError, requests.ConnectionError, requests.Timeout) as e:
+            # Raised by session.get once urllib3 has used up its retries.
+            error = e
+            break
+        except Exception as e:
+            if progress_bar:
+                progress_bar.close()
+            error = e
+            if attempt < max_retries:
+                print(f"Error downloading {url}: {e}. Retrying in {retry_delay} seconds (attempt {attempt}).")
+    get_download_errors_logger(username).error(f"Failed to download {url} after {attempt + 1} attempts. Error: {error}")
+    return False
 
 def categorize_item(item):
     """Categorize the item based on its type."""
-    item_type = item.get("type", "").upper()
-    if item_type == 'CHECKPOINT':
-        return 'Checkpoints'
-    elif item_type == 'TEXTUALINVERSION':
-        return 'Embeddings'
-    elif item_type == 'LORA':
-        return 'Lora'
-    elif item_type == 'TRAINING_DATA':
-        return 'Training_Data'
-    else:
+    item_type = item.get("type")
+    if not item_type:
         return 'Other'
+    category = CATEGORY_BY_TYPE.get(item_type)
+    if category is None:
+        category = CATEGORY_BY_TYPE.get(item_type.upper(), 'Other')
+    return category
 
-def download_model_files(username, item_name, model_version, item, download_type, exclude_type, failed_downloads_file):
+def download_model_files(username, item_name, model_version, item, base_model, download_type, exclude_type,
+                         failed_log, failed_log_lock, model_executor, image_executor, total_progress):
     """Download all files for one model version, saving them in a version subfolder.
     The preview image is saved in the version folder, additional images in an 'examples' subfolder,
     and an additional JSON file (base.json) is created containing a simple description and notes.
+    Failures are appended to failed_log under failed_log_lock.
     """
     model_id = item['id']
     model_id_formatted = f"{model_id:07d}"
@@ -210,7 +451,6 @@ def download_model_files(username, item_name, model_version, item, download_type
     
     # Use the model’s primary category for the parent folder.
     primary_category = categorize_item(item)
-    base_model = item.get('baseModel')
     if base_model:
         model_folder = os.path.join(OUTPUT_DIR, username, primary_category, base_model, item_name_sanitized)
     else:
@@ -220,41 +460,57 @@ def download_model_files(username, item_name, model_version, item, download_type
     version_folder_raw = model_version.get('name', 'Version Unknown')
     version_folder = sanitize_name(version_folder_raw)
     final_dir = os.path.join(model_folder, version_folder)
-    os.makedirs(final_dir, exist_ok=True)
     
     model_url = f"https://civitai.com/models/{model_id}"
     
-    # Determine a base file name from the first file entry (e.g. "kyl13-001" from "kyl13-001.pt").
-    base_file_name = None
+    # Split every file name once; the first one gives the base file name (e.g. "kyl13-001" from "kyl13-001.pt").
     files = model_version.get('files', [])
-    for file in files:
-        file_name = file.get('name', '')
-        if file_name:
-            base_file_name = os.path.splitext(file_name)[0]
-            break
+    split_file_names = [os.path.splitext(file.get('name', '')) for file in files]
+    base_file_name = next((base for base, extension in split_file_names if base or extension), None)
+    
+    # Skip the whole version if it was completed by an earlier run and the model JSON is unchanged.
+    # Download counts and ratings change all the time, so the stats are left out of the hash.
+    stable_item = {key: value for key, value in item.items() if key != 'stats'}
+    stable_item['modelVersions'] = [
+        {key: value for key, value in version.items() if key != 'stats'}
+        for version in item.get('modelVersions', [])
+    ]
+    stable_json = json.dumps({**stable_item, 'baseModel': base_model}, sort_keys=True)
+    info_hash = hashlib.blake2b(stable_json.encode('utf-8'), digest_size=16).hexdigest()
+    etag_path = os.path.join(final_dir, f"{base_file_name or item_name_sanitized}.etag")
+    try:
+        with open(etag_path, "r", encoding="utf-8") as f:
+            if f.read().strip() == info_hash:
+                return item_name, True, {}
+    except FileNotFoundError:
+        pass
+    
+    ensure_dir(final_dir)
+    # One directory listing per folder replaces a stat call per file for finished downloads.
+    existing_files = list_dir_names(final_dir)
     
+    # True once at least one model file (not just an image) is on disk.
     downloaded = False
-    # Download all model files.
-    for file in files:
+    # Maps each queued download to (entry for the failed downloads file, is model file); the preview maps to None.
+    download_futures = {}
+    # Queue all model files.
+    for file, split_file_name in zip(files, split_file_names):
         file_name = file.get('name', '')
         file_url = file.get('downloadUrl', '')
         if not file_name or not file_url:
             print(f"Invalid file entry: {file}")
             continue
-        if '?' in file_url:
-            file_url += f"&token={token}&nsfw=true"
-        else:
-            file_url += f"?token={token}&nsfw=true"
-        file_name_sanitized = sanitize_name(file_name, item_name, max_length=MAX_PATH_LENGTH)
-        file_path = os.path.join(final_dir, file_name_sanitized)
-        success = download_file_or_image(file_url, file_path, username)
-        if success:
+        separator = '&' if '?' in file_url else '?'
+        file_url = f"{file_url}{separator}{download_query}"
+        file_name_sanitized = sanitize_name(split_file_name, item_name, max_length=MAX_PATH_LENGTH)
+        if is_downloaded(file_name_sanitized, existing_files):
             downloaded = True
-        else:
-            with open(failed_downloads_file, "a", encoding='utf-8') as f:
-                f.write(f"Item Name: {item_name}\nFile URL: {file_url}\n---\n")
+            continue
+        file_path = os.path.join(final_dir, file_name_sanitized)
+        future = model_executor.submit(download_file_or_image, file_url, file_path, username, total_progress)
+        download_futures[future] = (f"Item Name: {item_name}\nFile URL: {file_url}\n---\n", True)
     
-    # Download the preview image (first valid image).
+    # Queue the preview image (first valid image).
     preview_filename = ""
     if base_file_name:
         preview_filename = f"{base_file_name}.preview.jpg"
@@ -266,13 +522,18 @@ def download_model_files(username, item_name, model_version, item, download_type
     for image in images:
         if image.get("type", "image").lower() == "image":
             preview_url = image.get("url", "")
-            if preview_url and download_file_or_image(preview_url, preview_path, username):
+            if preview_url and is_downloaded(preview_filename, existing_files):
+                preview_url_used = preview_url
+            elif preview_url:
+                future = image_executor.submit(download_file_or_image, preview_url, preview_path, username, total_progress)
+                download_futures[future] = None
                 preview_url_used = preview_url
             break  # Use only the first valid image as preview.
     
     # Create an "examples" subfolder for additional images.
     examples_dir = os.path.join(final_dir, "examples")
-    os.makedirs(examples_dir, exist_ok=True)
+    ensure_dir(examples_dir)
+    existing_examples = list_dir_names(examples_dir)
     for image in images:
         image_url = image.get("url", "")
         if not image_url:
@@ -283,16 +544,14 @@ def download_model_files(username, item_name, model_version, item, download_type
         image_id = image.get('id', '')
         image_filename_raw = f"{item_name}_{image_id}.jpeg"
         image_filename_sanitized = sanitize_name(image_filename_raw, item_name, max_length=MAX_PATH_LENGTH)
-        image_path = os.path.join(examples_dir, image_filename_sanitized)
         if not image_id or not image_url:
             print(f"Invalid image entry: {image}")
             continue
-        success = download_file_or_image(image_url, image_path, username)
-        if success:
-            downloaded = True
-        else:
-            with open(failed_downloads_file, "a", encoding='utf-8') as f:
-                f.write(f"Item Name: {item_name}\nImage URL: {image_url}\n---\n")
+        if is_downloaded(image_filename_sanitized, existing_examples):
+            continue
+        image_path = os.path.join(examples_dir, image_filename_sanitized)
+        future = image_executor.submit(download_file_or_image, image_url, image_path, username, total_progress)
+        download_futures[future] = (f"Item Name: {item_name}\nImage URL: {image_url}\n---\n", False)
     
     # Save the full info file with the model's JSON.
     if base_file_name:
@@ -301,7 +560,7 @@ def download_model_files(username, item_name, model_version, item, download_type
         info_filename = f"{item_name_sanitized}.civitai.info"
     info_path = os.path.join(final_dir, info_filename)
     with open(info_path, "w", encoding="utf-8") as f:
-        json.dump(item, f, indent=4)
+        json.dump({**item, 'baseModel': base_model}, f, indent=4)
     
     # Create an additional JSON file (base.json) with only the description and trainedWords.
     if base_file_name:
@@ -310,7 +569,7 @@ def download_model_files(username, item_name, model_version, item, download_type
         basejson_filename = f"{item_name_sanitized}.json"
     basejson_path = os.path.join(final_dir, basejson_filename)
     # Use the cleaned description (strip HTML) and the trainedWords as notes.
-    clean_description = re.sub(r'<[^>]*>', '', item.get('description', ''))
+    clean_description = HTML_TAG_RE.sub('', item.get('description', ''))
     trigger_words = model_version.get('trainedWords', [])
     if isinstance(trigger_words, list):
         notes = ", ".join(trigger_words)
@@ -323,10 +582,55 @@ def download_model_files(username, item_name, model_version, item, download_type
     with open(basejson_path, "w", encoding="utf-8") as f:
         json.dump(basejson_data, f, indent=4)
     
+    # Wait for the queued downloads and record failures.
+    all_succeeded = True
+    for future in as_completed(download_futures):
+        success = future.result()
+        all_succeeded = all_succeeded and success
+        if download_futures[future] is None:
+            continue
+        failed_entry, is_model_file = download_futures[future]
+        if success:
+            downloaded = downloaded or is_model_file
+        else:
+            with failed_log_lock:
+                failed_log.write(failed_entry)
+    
+    if all_succeeded and downloaded:
+        with open(etag_path, "w", encoding="utf-8") as f:
+            f.write(info_hash)
+    
     return item_name, downloaded, {}
 
 
 
+def download_worker(version_queue, downloaded_counter, counted_model_ids, counter_lock, progress_bar):
+    """Download model versions taken from version_queue until a None sentinel arrives.
+    Each task is (category, model id, download_model_files arguments); models with at least
+    one downloaded model file are counted once per category in downloaded_counter.
+    """
+    while True:
+        task = version_queue.get()
+        if task is None:
+            version_queue.task_done()
+            return
+        if stop_requested.is_set():
+            version_queue.task_done()
+            continue
+        item_category, model_id, download_args = task
+        try:
+            _, downloaded, _ = download_model_files(*download_args)
+        except Exception as e:
+            downloaded = False
+            logger_md.error(f"Error downloading model {model_id}: {e}")
+        if downloaded:
+            with counter_lock:
+                if model_id not in counted_model_ids:
+                    counted_model_ids.add(model_id)
+                    downloaded_counter[item_category] += 1
+        progress_bar.update(1)
+        version_queue.task_done()
+
 def process_username(username, download_type, exclude_type=None):
     """Process a username and download the specified type of content."""
     if download_type is not None:
@@ -334,24 +638,17 @@ def process_username(username, download_type, exclude_type=None):
     elif exclude_type is not None:
         print(f"Processing username: {username}, Excluding type: {exclude_type}")
     
-    fetch_user_data = fetch_all_models(token, username)
-    summary_data = read_summary_data(username)
-    total_items = summary_data.get('Total', 0)
-    
-    if download_type is not None:
-        if download_type == 'All':
-            selected_type_count = total_items
-            intentionally_skipped = 0
-        else:
-            selected_type_count = summary_data.get(download_type, 0)
-            intentionally_skipped = total_items - selected_type_count
-    elif exclude_type is not None:
-        selected_type_count = total_items - summary_data.get(exclude_type, 0)
-        intentionally_skipped = summary_data.get(exclude_type, 0)
+    # The summary file in the logs subfolder is written during the download pass: item names
+    # are streamed to the detailed listing and the header counts are filled in at the end.
+    summary_counts = collections.Counter({category: 0 for category in ['Checkpoints', 'Embeddings', 'Lora', 'Training_Data', 'Other']})
+    summary_file = open(os.path.join(LOGS_DIR, f"{username}.txt"), "w", encoding='utf-8')
+    write_summary_header(summary_file, summary_counts)
     
     failed_downloads_file = os.path.join(LOGS_DIR, f"failed_downloads_{username}.txt")
-    with open(failed_downloads_file, "w", encoding='utf-8') as f:
-        f.write(f"Failed Downloads for Username: {username}\n\n")
+    # Opened once and line buffered; every worker writes to it under failed_log_lock.
+    failed_log = open(failed_downloads_file, "w", buffering=1, encoding='utf-8')
+    failed_log_lock = threading.Lock()
+    failed_log.write(f"Failed Downloads for Username: {username}\n\n")
     
     params = {
         "username": username,
@@ -359,11 +656,42 @@ def process_username(username, download_type, exclude_type=None):
     }
     url = f"{BASE_URL}?{urllib.parse.urlencode(params)}&nsfw=true"
     
-    headers = {"Content-Type": "application/json"}
     next_page = url
-    first_next_page = None
+    # Pages already requested; a repeated nextPage URL ends pagination instead of looping forever.
+    seen_pages = {next_page}
+    # A single background thread fetches the next page while the current one downloads.
+    page_executor = ThreadPoolExecutor(max_workers=1)
+    page_future = page_executor.submit(request_page, next_page)
+    
+    # Separate pools for file and image downloads, shared by every model version of this user.
+    image_executor = ThreadPoolExecutor(max_workers=user_threads * 4)
+    model_executor = ThreadPoolExecutor(max_workers=max(2, user_threads // 2))
+    
+    # Model versions are handed to user_threads long-lived workers through a bounded queue,
+    # so pagination blocks once user_threads * 4 versions are waiting.
+    version_queue = queue.Queue(maxsize=user_threads * 4)
+    # Models with at least one downloaded model file, counted per category.
+    downloaded_counter = collections.Counter()
+    counted_model_ids = set()
+    counter_lock = threading.Lock()
+    progress_bar = tqdm(desc="Downloading Files", unit="file", leave=False)
+    # One byte counter for every download of this user instead of a bar per file.
+    total_progress = tqdm(desc="Downloaded", unit='B', unit_scale=True, smoothing=0.1, leave=False)
+    workers = [
+        threading.Thread(
+            target=download_worker,
+            args=(version_queue, downloaded_counter, counted_model_ids, counter_lock, progress_bar),
+            daemon=True
+        )
+        for _ in range(user_threads)
+    ]
+    for worker in workers:
+        worker.start()
     
     while True:
+        if stop_requested.is_set():
+            print(f"Stopping {username}: interrupted.")
+            break
         if next_page is None:
             print("End of pagination reached: 'next_page' is None.")
             break
@@ -374,10 +702,20 @@ def process_username(username, download_type, exclude_type=None):
         
         while retry_count < max_retries:
             try:
-                response = session.get(next_page, headers=headers)
+                if page_future is not None:
+                    # A failed prefetch is retried below with a fresh request.
+                    prefetched, page_future = page_future, None
+                    response = prefetched.result()
+                else:
+                    response = request_page(next_page)
                 response.raise_for_status()
-                data = response.json()
+                data = decode_json_response(response)
                 break
+            except (requests.exceptions.RetryError, requests.ConnectionError, requests.Timeout) as e:
+                # The session's urllib3 Retry has already retried this request.
+                print(f"Error making API request: {e}")
+                print("Maximum retries exceeded. Exiting.")
+                exit()
             except (requests.RequestException, TimeoutError, json.JSONDecodeError) as e:
                 print(f"Error making API request or decoding JSON response: {e}")
                 retry_count += 1
@@ -394,16 +732,19 @@ def process_username(username, download_type, exclude_type=None):
         if not metadata and not items:
             print("Termination condition met: 'metadata' is empty.")
             break
-        if first_next_page is None:
-            first_next_page = next_page
+        if next_page in seen_pages:
+            print(f"Termination condition met: nextPage URL repeated: {next_page}")
+            next_page = None
+        if next_page is not None:
+            seen_pages.add(next_page)
+            page_future = page_executor.submit(request_page, next_page)
         
-        executor = ThreadPoolExecutor(max_workers=max_threads)
-        download_futures = []
         downloaded_item_names = set()
         
         for item in items:
              # Determine the item's category
             item_category = categorize_item(item)
+            record_summary_item(summary_file, summary_counts, item, item_category)
             
             # Handle exclude_type
             if exclude_type is not None:
@@ -419,40 +760,51 @@ def process_username(username, download_type, exclude_type=None):
                 continue
             downloaded_item_names.add(item_name)
             for version in model_versions:
-                item_with_base_model = item.copy()
-                item_with_base_model['baseModel'] = version.get('baseModel')
-                future = executor.submit(
-                    download_model_files,
+                version_queue.put((item_category, item['id'], (
                     username,
                     item_name,
                     version,
-                    item_with_base_model,
+                    item,
+                    version.get('baseModel'),
                     download_type,
                     exclude_type,
-                    failed_downloads_file
-                )
-                download_futures.append(future)
-        
-        for future in tqdm(download_futures, desc="Downloading Files", unit="file", leave=False):
-            future.result()
-        
-        executor.shutdown()
+                    failed_log,
+                    failed_log_lock,
+                    model_executor,
+                    image_executor,
+                    total_progress
+                )))
+    
+    # One sentinel per worker, then wait for the queue to drain.
+    for _ in workers:
+        version_queue.put(None)
+    version_queue.join()
+    for worker in workers:
+        worker.join()
+    progress_bar.close()
+    total_progress.close()
+    page_executor.shutdown()
+    image_executor.shutdown()
+    model_executor.shutdown()
+    failed_log.close()
+    summary_file.seek(0)
+    write_summary_header(summary_file, summary_counts)
+    summary_file.close()
     
+    total_items = sum(summary_counts.values())
     if download_type is not None:
         if download_type == 'All':
-            downloaded_count = sum(
-                len(os.listdir(os.path.join(OUTPUT_DIR, username, category)))
-                for category in ['Lora', 'Checkpoints', 'Embeddings', 'Training_Data', 'Other']
-                if os.path.exists(os.path.join(OUTPUT_DIR, username, category))
-            )
+            selected_type_count = total_items
+            intentionally_skipped = 0
         else:
-            downloaded_count = len(os.listdir(os.path.join(OUTPUT_DIR, username, download_type))) if os.path.exists(os.path.join(OUTPUT_DIR, username, download_type)) else 0
+            selected_type_count = summary_counts[download_type]
+            intentionally_skipped = total_items - selected_type_count
     elif exclude_type is not None:
-        categories = [cat for cat in ['Lora', 'Checkpoints', 'Embeddings', 'Training_Data', 'Other'] if cat != exclude_type]
-        downloaded_count = sum(
-            len(os.listdir(os.path.join(OUTPUT_DIR, username, cat)))
-            for cat in categories if os.path.exists(os.path.join(OUTPUT_DIR, username, cat))
-        )
+        selected_type_count = total_items - summary_counts[exclude_type]
+        intentionally_skipped = summary_counts[exclude_type]
+    
+    # Only the selected categories were downloaded, so every counted model is part of the selection.
+    downloaded_count = sum(downloaded_counter.values())
     
     failed_count = selected_type_count - downloaded_count
     print(f"Total items for username {username}: {total_items}")
@@ -470,58 +822,45 @@ def search_for_training_data_files(item):
                 training_data_files.append(file.get("name", ""))
     return training_data_files
 
-def fetch_all_models(token, username):
-    base_url = "https://civitai.com/api/v1/models"
-    categorized_items = {
-        'Checkpoints': [],
-        'Embeddings': [],
-        'Lora': [],
-        'Training_Data': [],
-        'Other': []
-    }
-    other_item_types = []
-    next_page = f"{base_url}?username={username}&token={token}&nsfw=true"
-    first_next_page = None
-    while next_page:
-        response = requests.get(next_page)
-        data = response.json()
-        for item in data.get("items", []):
-            try:
-                category = categorize_item(item)
-                categorized_items[category].append(item.get("name", ""))
-                training_data_files = search_for_training_data_files(item)
-                if training_data_files:
-                    categorized_items['Training_Data'].extend(training_data_files)
-                if category == 'Other':
-                    other_item_types.append((item.get("name", ""), item.get("type", None)))
-            except Exception as e:
-                logger_md.error(f"Error categorizing item: {item} - {e}")
-        metadata = data.get('metadata', {})
-        next_page = metadata.get('nextPage')
-        if first_next_page is None:
-            first_next_page = next_page
-        if next_page and next_page == first_next_page and next_page != next_page or not metadata:
-            logger_md.error("Termination condition met: first nextPage URL repeated.")
-            break
-    total_count = sum(len(items) for items in categorized_items.values())
-    summary_file_path = os.path.join(LOGS_DIR, f"{username}.txt")
-    with open(summary_file_path, "w", encoding='utf-8') as file:
-        file.write("Summary:\n")
-        file.write(f"Total - Count: {total_count}\n")
-        for category, items in categorized_items.items():
-            file.write(f"{category} - Count: {len(items)}\n")
-        file.write("\nDetailed Listing:\n")
-        for category, items in categorized_items.items():
-            file.write(f"{category} - Count: {len(items)}\n")
-            if category == 'Other':
-                for item_name, item_type in other_item_types:
-                    file.write(f"{category} - Item: {item_name} - Type: {item_type}\n")
-            else:
-                for item_name in items:
-                    file.write(f"{category} - Item: {item_name}\n")
-            file.write("\n")
-    return categorized_items
+def write_summary_header(file, counts):
+    """Write the summary block of a username summary file.
+    Counts are padded to a fixed width so the block can be rewritten in place once the final counts are known.
+    """
+    file.write("Summary:\n")
+    file.write(f"Total - Count: {sum(counts.values()):<{SUMMARY_COUNT_WIDTH}}\n")
+    for category, count in counts.items():
+        file.write(f"{category} - Count: {count:<{SUMMARY_COUNT_WIDTH}}\n")
+    file.write("\nDetailed Listing:\n")
+
+def record_summary_item(file, counts, item, category):
+    """Count an item (and its training data files) and add it to the detailed listing of the summary file."""
+    try:
+        item_name = item.get("name", "")
+        counts[category] += 1
+        if category == 'Other':
+            file.write(f"{category} - Item: {item_name} - Type: {item.get('type', None)}\n")
+        else:
+            file.write(f"{category} - Item: {item_name}\n")
+        for training_data_file in search_for_training_data_files(item):
+            counts['Training_Data'] += 1
+            file.write(f"Training_Data - Item: {training_data_file}\n")
+    except Exception as e:
+        logger_md.error(f"Error categorizing item: {item} - {e}")
 
 if __name__ == "__main__":
-    for username in usernames:
-        process_username(username, download_type, exclude_type)
+    if user_workers == 1:
+        for username in usernames:
+            process_username(username, download_type, exclude_type)
+    else:
+        user_executor = ThreadPoolExecutor(max_workers=user_workers)
+        user_futures = [user_executor.submit(process_username, username, download_type, exclude_type) for username in usernames]
+        try:
+            for future in user_futures:
+                future.result()
+        except KeyboardInterrupt:
+            # Don't wait for the other usernames; drop the ones that have not started yet
+            # and let the running ones stop after the downloads they have in progress.
+            stop_requested.set()
+            user_executor.shutdown(wait=False, cancel_futures=True)
+            raise
+        user_executor.shutdown()